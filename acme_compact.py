@@ -3,8 +3,10 @@
 
 import acme_lib
 import argparse
+import os
 import sys
 import textwrap
+import time
 
 
 def _gen_account_key(account_key, key_length, algorithm):
@@ -12,6 +14,15 @@ def _gen_account_key(account_key, key_length, algorithm):
     acme_lib.write_file(account_key, key)
 
 
+def _signing_agent(account_key, agent_socket):
+    agent = acme_lib.SigningAgent(account_key)
+    sys.stderr.write("\nStarting signing agent on '{0}'; use --account-key {1}{0} for other commands.\n".format(agent_socket, acme_lib.agent_key_prefix))
+    try:
+        agent.serve(agent_socket)
+    except KeyboardInterrupt:
+        pass
+
+
 def _gen_cert_key(key, key_length, algorithm):
     the_key = acme_lib.create_key(key_length=key_length, algorithm=algorithm)
     acme_lib.write_file(key, the_key)
@@ -27,6 +38,54 @@ def _gen_csr(domains, key, csr, must_staple):
     acme_lib.write_file(csr, the_csr)
 
 
+def _plan_csrs(domains, domains_file, max_sans, group_by, webroot_map, existing_csrs, job_prefix, must_staple):
+    if max_sans < 1:
+        raise ValueError("'--max-sans' must be at least 1!")
+    all_domains = domains.split(',') if domains is not None else []
+    if domains_file is not None:
+        all_domains.extend(acme_lib.read_domain_list(domains_file))
+    if not all_domains:
+        raise ValueError("Either '--domains' or '--domains-file' must be specified!")
+    if group_by == 'registered-domain':
+        group_for_domain = acme_lib.get_registered_domain
+    elif group_by == 'webroot':
+        if webroot_map is None:
+            raise ValueError("'--group-by webroot' requires '--webroot-map'!")
+        group_for_domain = acme_lib.read_webroot_map(webroot_map).get
+    elif group_by == 'none':
+        group_for_domain = None
+    else:
+        raise ValueError("Unknown grouping '{0}'!".format(group_by))
+    jobs = acme_lib.plan_certificates(all_domains, max_sans=max_sans, group_for_domain=group_for_domain,
+                                      existing_csrs=existing_csrs.split(',') if existing_csrs is not None else None)
+    index = 0
+    for job in jobs:
+        if job['csr'] is not None:
+            sys.stderr.write("Reusing CSR '{0}' ({1} domains).\n".format(job['csr'], len(job['domains'])))
+            continue
+        index += 1
+        key = '{0}{1:03d}.key'.format(job_prefix, index)
+        csr = '{0}{1:03d}.csr'.format(job_prefix, index)
+        sys.stdout.write('gen-key --key {0}\n'.format(key))
+        sys.stdout.write('gen-csr --key {0} --csr {1} --domains {2}{3}\n'.format(key, csr, ','.join(job['domains']), ' --must-staple' if must_staple else ''))
+    sys.stderr.write("Planned {0} certificates for {1} domains ({2} new).\n".format(len(jobs), len(set(domain.lower() for domain in all_domains)), index))
+
+
+def _ensure_csr(domains, key, csr, csr_store, must_staple, max_key_age, key_length, algorithm):
+    if acme_lib.ensure_key(key, max_age=max_key_age * 24 * 60 * 60 if max_key_age is not None else None, key_length=key_length, algorithm=algorithm):
+        sys.stderr.write("Created new key '{0}'.\n".format(key))
+    the_csr, created = acme_lib.get_stored_csr(csr_store, key, domains.split(','), must_staple=must_staple)
+    if created:
+        sys.stderr.write("Created new CSR in store '{0}'.\n".format(csr_store))
+    if os.path.exists(csr):
+        with open(csr, "r") as f:
+            if f.read() == the_csr:
+                sys.stderr.write("CSR '{0}' is unchanged.\n".format(csr))
+                return
+    acme_lib.write_file_atomic(csr, the_csr)
+    sys.stderr.write("Stored CSR at '{0}'.\n".format(csr))
+
+
 def _print_csr(csr):
     sys.stdout.write(acme_lib.get_csr_as_text(csr) + '\n')
 
@@ -49,14 +108,108 @@ def _get_intermediate(intermediate_url, cert):
         sys.stderr.write("Stored intermediate certificate at '{0}'.\n".format(cert))
 
 
-def _get_certificate(account_key, csr, acme_dir, CA, cert, email):
+def _gen_webroot_map(nginx_config, apache_config, webroot_map):
+    if nginx_config is None and apache_config is None:
+        raise ValueError("At least one of '--nginx-config' and '--apache-config' must be specified!")
+    rules = []
+    if nginx_config is not None:
+        rules.extend(acme_lib.read_nginx_webroots(nginx_config))
+    if apache_config is not None:
+        rules.extend(acme_lib.read_apache_webroots(apache_config))
+    content = ''.join('{0} {1}\n'.format(pattern, webroot) for pattern, webroot in rules)
+    if webroot_map is None:
+        sys.stdout.write(content)
+    else:
+        acme_lib.write_file_atomic(webroot_map, content)
+        sys.stderr.write("Stored {0} rules in webroot map '{1}'.\n".format(len(rules), webroot_map))
+
+
+def _get_folder_for_domain(acme_dir, webroot_map, required=True):
+    if acme_dir is not None and webroot_map is not None:
+        raise ValueError("Cannot specify both '--acme-dir' and '--webroot-map'!")
+    if webroot_map is not None:
+        return acme_lib.read_webroot_map(webroot_map)
+    if acme_dir is None and required:
+        raise ValueError("Either '--acme-dir' or '--webroot-map' must be specified!")
+    return acme_dir
+
+
+def _verify_challenges(state, folder_for_domain, verify, verify_per_backend):
+    if verify == 'filesystem':
+        if folder_for_domain is None:
+            raise ValueError("'--verify filesystem' requires '--acme-dir' or '--webroot-map'!")
+        acme_lib.verify_challenges(state, folder_for_domain=folder_for_domain, per_backend=verify_per_backend)
+    elif verify == 'http':
+        acme_lib.verify_challenges(state, per_backend=verify_per_backend)
+    else:
+        raise ValueError("Unknown verification method '{0}'!".format(verify))
+
+
+# Maximal time between two scans of --cert-dir with refresh-ocsp --watch (in seconds)
+_OCSP_RESCAN_INTERVAL = 300
+
+
+# Finds the non-CA certificates in cert_dir. known maps filenames to their modification
+# time and whether they are such a certificate, so that unchanged files are not checked again.
+def _find_certificates(cert_dir, exclude, known):
+    exclude = set(os.path.realpath(filename) for filename in exclude)
+    result = []
+    for filename in sorted(os.listdir(cert_dir)):
+        path = os.path.join(cert_dir, filename)
+        if not filename.endswith(('.crt', '.pem')) or os.path.realpath(path) in exclude or not os.path.isfile(path):
+            continue
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if known.get(path, (None, ))[0] != mtime:
+            try:
+                with open(path, "r") as f:
+                    is_certificate = '-----BEGIN CERTIFICATE-----' in f.read()
+                is_certificate = is_certificate and not acme_lib.is_ca_certificate(path)
+            except (IOError, OSError, ValueError) as e:
+                sys.stderr.write("Skipping '{0}': {1}\n".format(path, e))
+                is_certificate = False
+            known[path] = (mtime, is_certificate)
+        if known[path][1]:
+            result.append(path)
+    return result
+
+
+def _refresh_ocsp(cert_dir, intermediate_cert, ocsp_dir, concurrency, force_refresh, watch):
+    if concurrency < 1:
+        raise ValueError("'--concurrency' must be at least 1!")
+    last_next_refresh = None
+    known_certs = {}
+    refresh_time_cache = {}
+    while True:
+        certs = _find_certificates(cert_dir, [intermediate_cert], known_certs)
+        refresh_times, errors = acme_lib.refresh_ocsp_responses(
+            certs, intermediate_cert, response_for_cert=ocsp_dir, concurrency=concurrency, force=force_refresh, cache=refresh_time_cache,
+            inform=lambda cert: sys.stderr.write("Stored OCSP response for '{0}'.\n".format(cert)))
+        for cert in sorted(errors):
+            sys.stderr.write("Cannot fetch OCSP response for '{0}': {1}\n".format(cert, errors[cert]))
+        next_refresh = min(list(refresh_times.values()) + ([time.time() + 300] if errors else []) or [time.time() + acme_lib.default_ocsp_refresh_interval])
+        if next_refresh != last_next_refresh:
+            sys.stderr.write("Next OCSP refresh due at {0}.\n".format(time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(next_refresh))))
+            last_next_refresh = next_refresh
+        if not watch:
+            if errors:
+                raise ValueError("Could not fetch {0} of {1} OCSP responses".format(len(errors), len(certs)))
+            return
+        force_refresh = False
+        time.sleep(min(max(60, next_refresh - time.time()), _OCSP_RESCAN_INTERVAL))
+
+
+def _get_certificate(account_key, csr, acme_dir, webroot_map, CA, cert, email, verify, verify_per_backend):
+    folder_for_domain = _get_folder_for_domain(acme_dir, webroot_map)
     sys.stderr.write("Preparing challenges...")
     state = acme_lib.get_challenges(account_key, csr, CA, email_address=email)
     sys.stderr.write(" ok\n")
     try:
         sys.stderr.write("Writing and verifying challenges...")
-        acme_lib.write_challenges(state, acme_dir)
-        acme_lib.verify_challenges(state)
+        acme_lib.write_challenges(state, folder_for_domain)
+        _verify_challenges(state, folder_for_domain, verify, verify_per_backend)
         sys.stderr.write(" ok\n")
         sys.stderr.write("Notifying CA of challenges...")
         acme_lib.notify_challenges(state)
@@ -70,15 +223,83 @@ def _get_certificate(account_key, csr, acme_dir, CA, cert, email):
             acme_lib.write_file(cert, result)
             sys.stderr.write("Stored certificate at '{0}'.\n".format(cert))
     finally:
-        acme_lib.remove_challenges(state, acme_dir)
+        acme_lib.remove_challenges(state, folder_for_domain)
 
 
-def _get_certificate_part1(statefile, account_key, csr, acme_dir, CA, email):
+def _get_certificates(account_key, csr, acme_dir, webroot_map, CA, email, concurrency):
+    if concurrency < 1:
+        raise ValueError("'--concurrency' must be at least 1!")
+    folder_for_domain = _get_folder_for_domain(acme_dir, webroot_map)
+    csrs = csr.split(',')
+    results, errors = acme_lib.get_certificates(
+        account_key, csrs, CA, folder_for_domain, email_address=email, concurrency=concurrency,
+        inform=lambda the_csr, domain: sys.stderr.write("Verified domain {0} for '{1}'!\n".format(domain, the_csr)))
+    for the_csr in sorted(results):
+        cert = (the_csr[:-4] if the_csr.endswith('.csr') else the_csr) + '.crt'
+        acme_lib.write_file(cert, results[the_csr])
+        sys.stderr.write("Stored certificate at '{0}'.\n".format(cert))
+    for the_csr in sorted(errors):
+        sys.stderr.write("Cannot retrieve certificate for '{0}': {1}\n".format(the_csr, errors[the_csr]))
+    if errors:
+        raise ValueError("Could not retrieve {0} of {1} certificates".format(len(errors), len(csrs)))
+
+
+def _get_certificate_dns(account_key, csr, CA, cert, email, dns_server, dns_port, dns_zone, dns_ttl, tsig_key_file, dns_hook, dns_nameservers, dns_nameserver_port, dns_propagation_timeout):
+    if (dns_server is None) == (dns_hook is None):
+        raise ValueError("Exactly one of '--dns-server' and '--dns-hook' must be specified!")
+    if dns_hook is not None:
+        provider = acme_lib.HookDNSProvider(dns_hook)
+    else:
+        if dns_zone is None:
+            raise ValueError("'--dns-zone' must be specified together with '--dns-server'!")
+        tsig_key = acme_lib.read_tsig_key_file(tsig_key_file) if tsig_key_file is not None else None
+        provider = acme_lib.RFC2136DNSProvider(dns_server, dns_zone, port=dns_port, ttl=dns_ttl, tsig_key=tsig_key)
+    if dns_nameservers is not None:
+        nameservers = dns_nameservers.split(',')
+    elif dns_server is not None:
+        nameservers = acme_lib.dns_query_ns(dns_server, dns_zone, port=dns_port)
+        if not nameservers:
+            raise ValueError("Cannot determine name servers of zone '{0}'; please specify '--dns-nameservers'!".format(dns_zone))
+    else:
+        nameservers = []
+    sys.stderr.write("Preparing challenges...")
+    state = acme_lib.get_challenges(account_key, csr, CA, email_address=email, challenge_type='dns-01')
+    sys.stderr.write(" ok\n")
+    try:
+        sys.stderr.write("Publishing DNS records...")
+        acme_lib.write_dns_challenges(state, provider)
+        sys.stderr.write(" ok\n")
+        sys.stderr.write("Waiting for DNS propagation...")
+        if nameservers:
+            acme_lib.wait_for_dns_challenges(state, nameservers, port=dns_nameserver_port, timeout=dns_propagation_timeout)
+        else:
+            time.sleep(dns_propagation_timeout)
+        sys.stderr.write(" ok\n")
+        sys.stderr.write("Notifying CA of challenges...")
+        acme_lib.notify_challenges(state)
+        sys.stderr.write(" ok\n")
+        sys.stderr.write("Verifying domains...\n")
+        result = acme_lib.check_challenges(state, csr, lambda domain: sys.stderr.write("Verified domain {0}!\n".format(domain)))
+        sys.stderr.write("Certificate is signed!\n")
+        if cert is None:
+            sys.stdout.write(result)
+        else:
+            acme_lib.write_file(cert, result)
+            sys.stderr.write("Stored certificate at '{0}'.\n".format(cert))
+    finally:
+        try:
+            acme_lib.remove_dns_challenges(state, provider)
+        except Exception as e:
+            sys.stderr.write("Cannot remove DNS records: {0}\n".format(e))
+
+
+def _get_certificate_part1(statefile, account_key, csr, acme_dir, webroot_map, CA, email):
+    folder_for_domain = _get_folder_for_domain(acme_dir, webroot_map)
     sys.stderr.write("Preparing challenges...")
     state = acme_lib.get_challenges(account_key, csr, CA, email_address=email)
     sys.stderr.write(" ok\n")
     sys.stderr.write("Writing challenges...")
-    acme_lib.write_challenges(state, acme_dir)
+    acme_lib.write_challenges(state, folder_for_domain)
     sys.stderr.write(" ok\n")
     sys.stderr.write("Serializing state...")
     with open(statefile, "w") as sf:
@@ -86,13 +307,14 @@ def _get_certificate_part1(statefile, account_key, csr, acme_dir, CA, email):
     sys.stderr.write(" ok\n")
 
 
-def _get_certificate_part2(statefile, csr, cert):
+def _get_certificate_part2(statefile, csr, cert, acme_dir, webroot_map, verify, verify_per_backend):
+    folder_for_domain = _get_folder_for_domain(acme_dir, webroot_map, required=False)
     sys.stderr.write("Deserializing state...")
     with open(statefile, "r") as sf:
         state = acme_lib.deserialize_state(sf.read())
     sys.stderr.write(" ok\n")
     sys.stderr.write("Verifying challenges...")
-    acme_lib.verify_challenges(state)
+    _verify_challenges(state, folder_for_domain, verify, verify_per_backend)
     sys.stderr.write(" ok\n")
     sys.stderr.write("Notifying CA of challenges...")
     acme_lib.notify_challenges(state)
@@ -116,8 +338,8 @@ if __name__ == "__main__":
                 Let's Encrypt using the ACME protocol. It can both be run from the server
                 and from another machine (when splitting the process up in two steps).
                 The script needs to have access to your private account key, so PLEASE READ
-                THROUGH IT! It's only 265+569 lines (including docstrings), so it won't
-                take too long.
+                THROUGH IT! The core ACME code is only a small part of acme_lib.py; most of
+                the code implements optional commands.
 
                 ===Example Usage: Creating Letsencrypt account key, private key for certificate and CSR===
                 python acme_compact.py gen-account-key --account-key /path/to/account.key
@@ -126,6 +348,17 @@ if __name__ == "__main__":
                 ===================
                 Note that the email address does not have to be specified.
 
+                ===Example Usage: Renewing without key or CSR work if nothing changed===
+                python acme_compact.py ensure-csr --key /path/to/domain.key --csr /path/to/domain.csr --domains example.com,www.example.com --csr-store /path/to/csr-store/ --max-key-age 90
+                ===================
+                This only creates the key if it does not exist or is older than 90 days, and only creates a CSR if the
+                store does not contain one for this key, domain set and --must-staple setting yet.
+
+                ===Example Usage: Planning CSRs for a large list of hostnames===
+                python acme_compact.py plan-csrs --domains-file /path/to/hostnames.txt --group-by registered-domain --existing-csrs /path/to/a.csr,/path/to/b.csr --job-prefix /path/to/cert- | xargs -L1 python acme_compact.py
+                ===================
+                This prints one "gen-key" and one "gen-csr" command line per new certificate.
+
                 Also note that by default, RSA keys are generated. If you want ECC keys,
                 please specify "--algorithm <alg>" with <alg> being "p-256" or "p-384".
 
@@ -133,12 +366,40 @@ if __name__ == "__main__":
                 python acme_compact.py get-certificate --account-key /path/to/account.key --email mail@example.com --csr /path/to/domain.csr --acme-dir /usr/share/nginx/html/.well-known/acme-challenge/ --cert /path/to/signed.crt 2>> /var/log/acme_compact.log
                 ===================
 
+                ===Example Usage: Creating certifiate from CSR on server with many webroots===
+                python acme_compact.py gen-webroot-map --nginx-config /etc/nginx/nginx.conf --webroot-map /path/to/webroots.map
+                python acme_compact.py get-certificate --account-key /path/to/account.key --csr /path/to/domain.csr --webroot-map /path/to/webroots.map --cert /path/to/signed.crt 2>> /var/log/acme_compact.log
+                ===================
+
+                ===Example Usage: Creating several certificates at once===
+                python acme_compact.py get-certificates --account-key /path/to/account.key --csr /path/to/a.csr,/path/to/b.csr --acme-dir /usr/share/nginx/html/.well-known/acme-challenge/ 2>> /var/log/acme_compact.log
+                ===================
+                This stores the certificates as /path/to/a.crt and /path/to/b.crt.
+
+                ===Example Usage: Creating certifiate from CSR with DNS challenges (RFC 2136 dynamic updates)===
+                python acme_compact.py get-certificate-dns --account-key /path/to/account.key --csr /path/to/domain.csr --dns-server ns1.example.com --dns-zone example.com --tsig-key-file /path/to/tsig.key --cert /path/to/signed.crt 2>> /var/log/acme_compact.log
+                ===================
+                Instead of --dns-server, --dns-hook /path/to/program can be used. It is called once for all records
+                of the certificate as "program add <name> <value> [<name> <value> ...]" (resp. "program remove ...").
+
                 ===Example Usage: Creating certifiate from CSR from another machine===
                 python acme_compact.py get-certificate-part-1 --account-key /path/to/account.key --email mail@example.com --csr /path/to/domain.csr --statefile /path/to/state.json --acme-dir /tmp/acme-challenge/ 2>> /var/log/acme_compact.log
                 ... copy files from /tmp/acme-challenge/ into /usr/share/nginx/html/.well-known/acme-challenge/ on the web server ...
                 python acme_compact.py get-certificate-part-2 --csr /path/to/domain.csr --statefile /path/to/state.json --cert /path/to/signed.crt 2>> /var/log/acme_compact.log
                 ===================
 
+                ===Example Usage: Keeping OCSP responses for OCSP stapling fresh===
+                python acme_compact.py get-intermediate --cert /path/to/intermediate.crt
+                python acme_compact.py refresh-ocsp --cert-dir /path/to/certs/ --intermediate-cert /path/to/intermediate.crt --watch
+                ===================
+                This stores the DER encoded OCSP response for /path/to/certs/domain.crt as /path/to/certs/domain.crt.ocsp,
+                and refreshes every response half way between its This Update and Next Update times.
+
+                ===Example Usage: Loading the account key once into a signing agent===
+                python acme_compact.py signing-agent --account-key /path/to/account.key --agent-socket /run/acme-agent.sock &
+                python acme_compact.py get-certificate --account-key agent:/run/acme-agent.sock --csr /path/to/domain.csr --acme-dir /usr/share/nginx/html/.well-known/acme-challenge/ --cert /path/to/signed.crt
+                ===================
+
                 ===Example Usage: Combining signed certificate with intermediate certificate===
                 python acme_compact.py get-intermediate --cert /path/to/domain-intermediate.crt
                 cat /path/to/signed.crt /path/to/domain-intermediate.crt > /path/to/signed-with-intermediate.crt
@@ -152,6 +413,12 @@ if __name__ == "__main__":
                 'optional': ["key_length", "algorithm"],
                 'command': _gen_account_key,
             },
+            'signing-agent': {
+                'help': 'Loads the account key once and signs requests for other processes over a Unix socket. Other commands can use it with --account-key agent:/path/to/socket. The key file is only read at startup, but every signature is still created by running OpenSSL.',
+                'requires': ["account_key", "agent_socket"],
+                'optional': [],
+                'command': _signing_agent,
+            },
             'gen-key': {
                 'help': 'Generates a certificate key.',
                 'requires': ["key"],
@@ -164,6 +431,18 @@ if __name__ == "__main__":
                 'optional': ["must_staple"],
                 'command': _gen_csr,
             },
+            'plan-csrs': {
+                'help': 'Distributes a list of domains over few certificates (using the first-fit decreasing heuristic), respecting the SAN limit per certificate and reusing existing CSRs where this does not cost an extra certificate. Prints the gen-key and gen-csr command lines for the new certificates.',
+                'requires': [],
+                'optional': ["domains", "domains_file", "max_sans", "group_by", "webroot_map", "existing_csrs", "job_prefix", "must_staple"],
+                'command': _plan_csrs,
+            },
+            'ensure-csr': {
+                'help': 'Like gen-key and gen-csr, but only creates the key if it is missing or older than --max-key-age days, and takes the CSR from a content-addressed store if one exists for the key, domains and must-staple setting.',
+                'requires': ["domains", "key", "csr", "csr_store"],
+                'optional': ["must_staple", "max_key_age", "key_length", "algorithm"],
+                'command': _ensure_csr,
+            },
             'print-csr': {
                 'help': 'Prints the given certificate signing request (CSR) in human-readable form.',
                 'requires': ["csr"],
@@ -182,40 +461,92 @@ if __name__ == "__main__":
                 'optional': ["intermediate_url", "cert"],
                 'command': _get_intermediate,
             },
+            'refresh-ocsp': {
+                'help': 'Fetches OCSP responses for all end-entity certificates (*.crt, *.pem; CA certificates and chains are skipped) in a directory in parallel, and stores them DER encoded for OCSP stapling. Only responses which are missing or half way to their Next Update time are fetched.',
+                'requires': ["cert_dir", "intermediate_cert"],
+                'optional': ["ocsp_dir", "concurrency", "force_refresh", "watch"],
+                'command': _refresh_ocsp,
+            },
+            'gen-webroot-map': {
+                'help': 'Generates a webroot map (for --webroot-map) from the server blocks of an nginx configuration and/or the virtual hosts of an Apache configuration, and prints it to stdout (if --webroot-map is not specified).',
+                'requires': [],
+                'optional': ["nginx_config", "apache_config", "webroot_map"],
+                'command': _gen_webroot_map,
+            },
             'get-certificate': {
                 'help': 'Given a CSR and an account key, retrieves a certificate and prints it to stdout (if --cert is not specified).',
-                'requires': ["account_key", "csr", "acme_dir"],
-                'optional': ["CA", "cert", "email"],
+                'requires': ["account_key", "csr"],
+                'optional': ["acme_dir", "webroot_map", "CA", "cert", "email", "verify", "verify_per_backend"],
                 'command': _get_certificate,
             },
+            'get-certificates': {
+                'help': 'Given a comma-separated list of CSRs and an account key, retrieves the certificates concurrently (up to --concurrency at a time) and stores them next to the CSRs (with extension .crt). Concurrent authorizations for domains shared by several CSRs are coalesced.',
+                'requires': ["account_key", "csr"],
+                'optional': ["acme_dir", "webroot_map", "CA", "email", "concurrency"],
+                'command': _get_certificates,
+            },
+            'get-certificate-dns': {
+                'help': 'Given a CSR and an account key, retrieves a certificate using DNS challenges and prints it to stdout (if --cert is not specified). The TXT records of all domains are published as one batch, either by RFC 2136 dynamic updates (--dns-server) or by an external program (--dns-hook).',
+                'requires': ["account_key", "csr"],
+                'optional': ["CA", "cert", "email", "dns_server", "dns_port", "dns_zone", "dns_ttl", "tsig_key_file", "dns_hook", "dns_nameservers", "dns_nameserver_port", "dns_propagation_timeout"],
+                'command': _get_certificate_dns,
+            },
             'get-certificate-part-1': {
                 'help': 'Given a CSR and an account key, prepares retrieving a certificate. The generated challenge files must be manually uploaded to their respective positions.',
-                'requires': ["account_key", "csr", "acme_dir", "statefile"],
-                'optional': ["CA", "email"],
+                'requires': ["account_key", "csr", "statefile"],
+                'optional': ["acme_dir", "webroot_map", "CA", "email"],
                 'command': _get_certificate_part1,
             },
             'get-certificate-part-2': {
                 'help': 'Assuming that get-certificate-part-1 ran through and the challenges were uploaded, retrieves a certificate and prints it to stdout (if --cert is not specified).',
                 'requires': ["csr", "statefile"],
-                'optional': ["cert"],
+                'optional': ["cert", "acme_dir", "webroot_map", "verify", "verify_per_backend"],
                 'command': _get_certificate_part2,
             },
         }
         parser.add_argument("command", type=str, nargs='?', help="must be one of {0}".format(', '.join('"{0}"'.format(command) for command in sorted(commands.keys()))))
         parser.add_argument("--account-key", required=False, help="path to your Let's Encrypt account private key")
+        parser.add_argument("--agent-socket", required=False, help="path of the Unix socket for the signing agent")
         parser.add_argument("--algorithm", required=False, default="rsa", help="the algorithm to use (rsa, ...)")  # FIXME
         parser.add_argument("--key-length", type=int, default=4096, required=False, help="key length for private keys")
         parser.add_argument("--key", required=False, help="path to your certificate's private key")
         parser.add_argument("--csr", required=False, help="path to your certificate signing request")
+        parser.add_argument("--csr-store", required=False, help="directory for storing CSRs by key, domains and must-staple setting")
+        parser.add_argument("--max-key-age", type=int, required=False, default=None, help="maximal age of the certificate key in days before it is replaced")
         parser.add_argument("--acme-dir", required=False, help="path to the .well-known/acme-challenge/ directory")
+        parser.add_argument("--verify", required=False, default="http", choices=["http", "filesystem"], help="check challenge files with HTTP, or directly in --acme-dir (default: http)")
+        parser.add_argument("--verify-per-backend", required=False, default=False, action='store_true', help="only check one domain per resolved backend with HTTP")
         parser.add_argument("--CA", required=False, default=None, help="CA to use (default: {0})".format(acme_lib.default_ca))
         parser.add_argument("--use-staging-CA", required=False, default=False, action='store_true', help="Use Let's Encrypt staging CA")
         parser.add_argument("--statefile", required=False, default=None, help="state file for two-part run")
         parser.add_argument("-d", "--domains", required=False, default=None, help="a comma-separated list of domain names")
+        parser.add_argument("--domains-file", required=False, default=None, help="file with domain names (one per line)")
+        parser.add_argument("--max-sans", type=int, default=100, required=False, help="maximal number of domains per certificate (default: 100)")
+        parser.add_argument("--group-by", required=False, default="none", choices=["none", "registered-domain", "webroot"], help="keep domains with the same registered domain or webroot in one certificate (default: none)")
+        parser.add_argument("--webroot-map", required=False, default=None, help="file mapping domains to .well-known/acme-challenge/ directories (lines '<pattern> <directory>' with patterns example.com, *.example.com, .example.com or *)")
+        parser.add_argument("--nginx-config", required=False, default=None, help="main nginx configuration file")
+        parser.add_argument("--apache-config", required=False, default=None, help="main Apache configuration file")
+        parser.add_argument("--existing-csrs", required=False, default=None, help="comma-separated list of existing CSRs which can be reused")
+        parser.add_argument("--job-prefix", required=False, default="cert-", help="prefix for key and CSR file names of planned certificates (default: cert-)")
         parser.add_argument("--cert", required=False, help="file name to store certificate into (otherwise it is printed on stdout)")
         parser.add_argument("--email", required=False, help="email address (will be associated with account)")
         parser.add_argument("--intermediate-url", required=False, default=acme_lib.default_intermediate_url, help="URL for the intermediate certificate (default: {0})".format(acme_lib.default_intermediate_url))
         parser.add_argument("--root-url", required=False, default=acme_lib.default_root_url, help="URL for the root certificate (default: {0})".format(acme_lib.default_root_url))
+        parser.add_argument("--dns-server", required=False, help="DNS server to send RFC 2136 dynamic updates to")
+        parser.add_argument("--dns-port", type=int, default=53, required=False, help="port of the DNS server to send updates to (default: 53)")
+        parser.add_argument("--dns-zone", required=False, help="DNS zone to update")
+        parser.add_argument("--dns-ttl", type=int, default=60, required=False, help="TTL for the TXT records (default: 60)")
+        parser.add_argument("--tsig-key-file", required=False, help="BIND style TSIG key file for dynamic updates")
+        parser.add_argument("--dns-hook", required=False, help="program which publishes and removes TXT records")
+        parser.add_argument("--dns-nameservers", required=False, help="comma-separated list of name servers to check for propagation (default: the NS records of --dns-zone)")
+        parser.add_argument("--dns-nameserver-port", type=int, default=53, required=False, help="port of the name servers to check for propagation (default: 53)")
+        parser.add_argument("--dns-propagation-timeout", type=int, default=300, required=False, help="maximal time to wait for DNS propagation in seconds; without name servers to check, the time to wait (default: 300)")
+        parser.add_argument("--cert-dir", required=False, help="directory containing the issued certificates")
+        parser.add_argument("--intermediate-cert", required=False, help="file containing the intermediate (issuer) certificate")
+        parser.add_argument("--ocsp-dir", required=False, default=None, help="directory to store OCSP responses in (default: --cert-dir)")
+        parser.add_argument("--concurrency", type=int, default=8, required=False, help="number of parallel requests (default: 8)")
+        parser.add_argument("--force-refresh", required=False, default=False, action='store_true', help="fetch OCSP responses even if they are not due yet")
+        parser.add_argument("--watch", required=False, default=False, action='store_true', help="keep running, refresh OCSP responses when they are due, and pick up new certificates every 5 minutes")
         parser.add_argument("--must-staple", required=False, default=False, action='store_true', help="request must staple extension for certificate")
 
         args = parser.parse_args()
@@ -11,19 +11,39 @@ The original acme-tiny code is Copyright (c) 2015 Daniel Roesler
 
 import base64
 import binascii
+import calendar
 import copy
+import errno
+import glob
 import hashlib
+import hmac
 import json
 import os
 import re
+import socket
+import stat
+import struct
 import subprocess
 import sys
 import textwrap
+import threading
 import time
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
 try:
     from urllib.request import urlopen, Request
 except ImportError:  # Python 2
     from urllib2 import urlopen, Request
+try:
+    _string_types = basestring
+except NameError:  # Python 3
+    _string_types = str
 
 
 staging_ca = "https://acme-staging.api.letsencrypt.org"
@@ -45,13 +65,22 @@ def _b64(b):
     return base64.urlsafe_b64encode(b).decode('utf8').replace("=", "")
 
 
-def _run_openssl(args, input=None):
-    """Execute OpenSSL with the given arguments. Feeds input via stdin if given."""
+def _run_openssl(args, input=None, pass_fds=()):
+    """Execute OpenSSL with the given arguments. Feeds input via stdin if given.
+
+    The file descriptors in pass_fds are kept open in the OpenSSL process.
+    """
+    kwargs = {}
+    if pass_fds:
+        if sys.version_info < (3, 2):
+            kwargs['close_fds'] = False
+        else:
+            kwargs['pass_fds'] = pass_fds
     if input is None:
-        proc = subprocess.Popen(["openssl"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc = subprocess.Popen(["openssl"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
         out, err = proc.communicate()
     else:
-        proc = subprocess.Popen(["openssl"] + list(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc = subprocess.Popen(["openssl"] + list(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
         out, err = proc.communicate(input)
     if proc.returncode != 0:
         raise IOError("OpenSSL Error: {0}".format(err.decode('utf-8')))
@@ -74,6 +103,76 @@ def _request(url, content_type=None):
     return Request(url, headers=headers)
 
 
+def _run_parallel(function, items, concurrency):
+    """Call function for every item, using up to concurrency threads.
+
+    Returns two dictionaries: one mapping items to results, and one
+    mapping items to exceptions for failed calls.
+    """
+    if concurrency < 1:
+        raise ValueError("Concurrency must be at least 1!")
+    results = {}
+    errors = {}
+    pending = queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[item] = function(item)
+            except Exception as e:
+                errors[item] = e
+
+    threads = [threading.Thread(target=worker) for i in range(min(concurrency, pending.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class _SingleFlight(object):
+    """Makes sure that a function runs only once at a time per key.
+
+    Concurrent callers with the same key wait for the running call and
+    share its outcome. Outcomes are not remembered; once the call is done,
+    the next caller runs the function again.
+    """
+
+    def __init__(self):
+        """Create empty single-flight group."""
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        """Return the result of function(), or of the call already running for key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = function()
+            return call['result']
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
 # #####################################################################################################
 # # Algorithm support
 
@@ -150,6 +249,438 @@ def _get_algorithm(algorithm):
     return _ALGORITHMS[algorithm]
 
 
+# #####################################################################################################
+# # DNS support (for dns-01 challenges)
+
+
+_DNS_TYPE_NS = 2
+_DNS_TYPE_SOA = 6
+_DNS_TYPE_TXT = 16
+_DNS_TYPE_TSIG = 250
+_DNS_CLASS_IN = 1
+_DNS_CLASS_NONE = 254
+_DNS_CLASS_ANY = 255
+_DNS_OPCODE_UPDATE = 5
+_DNS_RCODES = {
+    0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED',
+    6: 'YXDOMAIN', 7: 'YXRRSET', 8: 'NXRRSET', 9: 'NOTAUTH', 10: 'NOTZONE',
+}
+_TSIG_ALGORITHMS = {
+    'hmac-md5': ('hmac-md5.sig-alg.reg.int', hashlib.md5),
+    'hmac-sha1': ('hmac-sha1', hashlib.sha1),
+    'hmac-sha256': ('hmac-sha256', hashlib.sha256),
+    'hmac-sha512': ('hmac-sha512', hashlib.sha512),
+}
+
+
+def _dns_encode_name(name):
+    """Encode a domain name in DNS wire format (without compression)."""
+    result = b''
+    for label in name.rstrip('.').split('.'):
+        label = label.encode('ascii')
+        if not label or len(label) > 63:
+            raise ValueError("Invalid DNS name '{0}'!".format(name))
+        result += struct.pack('!B', len(label)) + label
+    return result + b'\x00'
+
+
+def _dns_skip_name(data, offset):
+    """Return the offset directly after the (possibly compressed) name starting at offset."""
+    while True:
+        length = struct.unpack_from('!B', data, offset)[0]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+
+
+def _dns_txt_rdata(value):
+    """Encode a single TXT string as RDATA."""
+    value = value.encode('ascii')
+    return struct.pack('!B', len(value)) + value
+
+
+def _dns_rr(name, rrtype, rrclass, ttl, rdata):
+    """Encode a resource record."""
+    return _dns_encode_name(name) + struct.pack('!HHIH', rrtype, rrclass, ttl, len(rdata)) + rdata
+
+
+def _dns_sign_tsig(message, key_name, secret, algorithm, fudge=300):
+    """Append a TSIG record (RFC 8945) to the given DNS message."""
+    if algorithm not in _TSIG_ALGORITHMS:
+        raise ValueError("Unknown TSIG algorithm '{0}'!".format(algorithm))
+    algorithm_name, digestmod = _TSIG_ALGORITHMS[algorithm]
+    message_id, arcount = struct.unpack_from('!H', message, 0)[0], struct.unpack_from('!H', message, 10)[0]
+    now = int(time.time())
+    time_signed = struct.pack('!HIH', (now >> 32) & 0xFFFF, now & 0xFFFFFFFF, fudge)
+    variables = (_dns_encode_name(key_name.lower()) + struct.pack('!HI', _DNS_CLASS_ANY, 0) +
+                 _dns_encode_name(algorithm_name) + time_signed + struct.pack('!HH', 0, 0))
+    mac = hmac.new(base64.b64decode(secret), message + variables, digestmod).digest()
+    rdata = (_dns_encode_name(algorithm_name) + time_signed + struct.pack('!H', len(mac)) + mac +
+             struct.pack('!HHH', message_id, 0, 0))
+    return message[:10] + struct.pack('!H', arcount + 1) + message[12:] + _dns_rr(key_name, _DNS_TYPE_TSIG, _DNS_CLASS_ANY, 0, rdata)
+
+
+def _dns_exchange(message, server, port=53, timeout=10):
+    """Send a DNS message to the server and return the response.
+
+    Uses UDP, and falls back to TCP for large messages and truncated responses.
+    """
+    message_id = struct.unpack_from('!H', message, 0)[0]
+    family, socktype, proto, canonname, address = socket.getaddrinfo(server, port, 0, socket.SOCK_DGRAM)[0]
+    if len(message) <= 512:
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(timeout)
+            sock.sendto(message, address)
+            while True:
+                response = sock.recv(65535)
+                if len(response) >= 12 and struct.unpack_from('!H', response, 0)[0] == message_id:
+                    break
+        finally:
+            sock.close()
+        if not struct.unpack_from('!H', response, 2)[0] & 0x0200:
+            return response
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.sendall(struct.pack('!H', len(message)) + message)
+        response = b''
+        while len(response) < 2 or len(response) < 2 + struct.unpack_from('!H', response, 0)[0]:
+            chunk = sock.recv(65535)
+            if not chunk:
+                raise IOError("DNS server {0} closed connection".format(server))
+            response += chunk
+        return response[2:]
+    finally:
+        sock.close()
+
+
+def _dns_check_rcode(response, server):
+    """Raise an exception if the DNS response indicates an error."""
+    rcode = struct.unpack_from('!H', response, 2)[0] & 0x000F
+    if rcode != 0:
+        raise ValueError("DNS server {0} returned {1}".format(server, _DNS_RCODES.get(rcode, rcode)))
+
+
+def dns_update(server, zone, add=None, delete=None, ttl=60, port=53, tsig_key=None, timeout=10):
+    """Send one RFC 2136 dynamic update to the server which adds and deletes the given TXT records.
+
+    ``add`` and ``delete`` are lists of ``(name, value)`` tuples. ``tsig_key``, if
+    specified, must be a tuple ``(key_name, algorithm, secret)`` with the base64
+    encoded secret, as returned by ``read_tsig_key_file()``.
+    """
+    updates = []
+    for name, value in delete or []:
+        updates.append(_dns_rr(name, _DNS_TYPE_TXT, _DNS_CLASS_NONE, 0, _dns_txt_rdata(value)))
+    for name, value in add or []:
+        updates.append(_dns_rr(name, _DNS_TYPE_TXT, _DNS_CLASS_IN, ttl, _dns_txt_rdata(value)))
+    message_id = struct.unpack('!H', os.urandom(2))[0]
+    message = struct.pack('!HHHHHH', message_id, _DNS_OPCODE_UPDATE << 11, 1, 0, len(updates), 0)
+    message += _dns_encode_name(zone) + struct.pack('!HH', _DNS_TYPE_SOA, _DNS_CLASS_IN)
+    message += b''.join(updates)
+    if tsig_key is not None:
+        message = _dns_sign_tsig(message, tsig_key[0], tsig_key[2], tsig_key[1])
+    _dns_check_rcode(_dns_exchange(message, server, port=port, timeout=timeout), server)
+
+
+def _dns_read_name(data, offset):
+    """Decode the (possibly compressed) name starting at offset."""
+    labels = []
+    for i in range(128):
+        length = struct.unpack_from('!B', data, offset)[0]
+        if length == 0:
+            return '.'.join(labels)
+        if length & 0xC0 == 0xC0:
+            offset = struct.unpack_from('!H', data, offset)[0] & 0x3FFF
+            continue
+        labels.append(data[offset + 1:offset + 1 + length].decode('ascii'))
+        offset += 1 + length
+    raise ValueError("Invalid compressed DNS name")
+
+
+def _dns_query(server, name, rrtype, port=53, timeout=10):
+    """Query the records of the given type for the name from the server.
+
+    Returns the response and a list of ``(offset, length)`` tuples for the
+    RDATA of the matching answer records.
+    """
+    message_id = struct.unpack('!H', os.urandom(2))[0]
+    message = struct.pack('!HHHHHH', message_id, 0x0100, 1, 0, 0, 0)
+    message += _dns_encode_name(name) + struct.pack('!HH', rrtype, _DNS_CLASS_IN)
+    response = _dns_exchange(message, server, port=port, timeout=timeout)
+    rcode = struct.unpack_from('!H', response, 2)[0] & 0x000F
+    if rcode == 3:
+        return response, []
+    _dns_check_rcode(response, server)
+    qdcount, ancount = struct.unpack_from('!HH', response, 4)
+    offset = 12
+    for i in range(qdcount):
+        offset = _dns_skip_name(response, offset) + 4
+    result = []
+    for i in range(ancount):
+        offset = _dns_skip_name(response, offset)
+        answer_type, answer_class, ttl, rdlength = struct.unpack_from('!HHIH', response, offset)
+        offset += 10
+        if answer_type == rrtype:
+            result.append((offset, rdlength))
+        offset += rdlength
+    return response, result
+
+
+def dns_query_txt(server, name, port=53, timeout=10):
+    """Query the TXT records for the given name from the server. Returns a list of strings."""
+    response, records = _dns_query(server, name, _DNS_TYPE_TXT, port=port, timeout=timeout)
+    result = []
+    for offset, rdlength in records:
+        rdata, value = response[offset:offset + rdlength], b''
+        while rdata:
+            length = struct.unpack_from('!B', rdata, 0)[0]
+            value, rdata = value + rdata[1:1 + length], rdata[1 + length:]
+        result.append(value.decode('ascii'))
+    return result
+
+
+def dns_query_ns(server, zone, port=53, timeout=10):
+    """Query the authoritative name servers (NS records) of the zone from the server. Returns a list of names."""
+    response, records = _dns_query(server, zone, _DNS_TYPE_NS, port=port, timeout=timeout)
+    return sorted(set(_dns_read_name(response, offset) for offset, rdlength in records))
+
+
+def read_tsig_key_file(filename):
+    """Read a BIND style TSIG key file (as used by ``nsupdate -k``).
+
+    Returns a tuple ``(key_name, algorithm, secret)``.
+    """
+    with open(filename, "r") as f:
+        content = f.read()
+    m = re.search(r'key\s+"?([^"\s{]+)"?\s*\{([^}]*)\}', content)
+    if m is None:
+        raise ValueError("Cannot find TSIG key in '{0}'!".format(filename))
+    algorithm = re.search(r'algorithm\s+"?([^";\s]+)"?\s*;', m.group(2))
+    secret = re.search(r'secret\s+"([^"]+)"\s*;', m.group(2))
+    if algorithm is None or secret is None:
+        raise ValueError("TSIG key in '{0}' lacks algorithm or secret!".format(filename))
+    return m.group(1).rstrip('.'), algorithm.group(1).lower(), secret.group(1)
+
+
+class DNSProvider(object):
+    """Abstracts a way to publish TXT records for dns-01 challenges.
+
+    All records of an order are passed in one call, so that providers can
+    publish them as one batch.
+    """
+
+    def __not_implemented(self, method):
+        """Helper method to raise not implemented errors."""
+        raise Exception("DNS provider {0} does not support {1}!".format(self.__class__.__name__, method))
+
+    def add_records(self, records):
+        """Publish the given list of ``(name, value)`` TXT records."""
+        self.__not_implemented('add_records')
+
+    def remove_records(self, records):
+        """Remove the given list of ``(name, value)`` TXT records."""
+        self.__not_implemented('remove_records')
+
+
+class RFC2136DNSProvider(DNSProvider):
+    """Publishes TXT records with RFC 2136 dynamic updates; one update is sent per zone."""
+
+    def __init__(self, server, zone, port=53, ttl=60, tsig_key=None, timeout=10):
+        """Create provider for given DNS server.
+
+        If the zone parameter is a callable, it is called with the record name
+        and must return the zone the record belongs to. Otherwise, it is assumed
+        to be a string. See ``dns_update()`` for ``tsig_key``.
+        """
+        self.server = server
+        self.zone = zone
+        self.port = port
+        self.ttl = ttl
+        self.tsig_key = tsig_key
+        self.timeout = timeout
+
+    def _by_zone(self, records):
+        zones = {}
+        for name, value in records:
+            zone = self.zone(name) if callable(self.zone) else self.zone
+            zones.setdefault(zone, []).append((name, value))
+        return zones
+
+    def add_records(self, records):
+        """Publish the given TXT records."""
+        for zone, zone_records in sorted(self._by_zone(records).items()):
+            dns_update(self.server, zone, add=zone_records, ttl=self.ttl, port=self.port, tsig_key=self.tsig_key, timeout=self.timeout)
+
+    def remove_records(self, records):
+        """Remove the given TXT records."""
+        for zone, zone_records in sorted(self._by_zone(records).items()):
+            dns_update(self.server, zone, delete=zone_records, port=self.port, tsig_key=self.tsig_key, timeout=self.timeout)
+
+
+class HookDNSProvider(DNSProvider):
+    """Publishes TXT records by calling an external program once per batch.
+
+    The program is called as ``<command> add <name> <value> [<name> <value> ...]``
+    respectively ``<command> remove <name> <value> [...]``, and must exit with 0.
+    """
+
+    def __init__(self, command):
+        """Create provider for given program (path or list of arguments)."""
+        self.command = [command] if isinstance(command, _string_types) else list(command)
+
+    def _run(self, action, records):
+        args = self.command + [action]
+        for name, value in records:
+            args.extend([name, value])
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise IOError("DNS hook error: {0}".format(err.decode('utf-8')))
+
+    def add_records(self, records):
+        """Publish the given TXT records."""
+        self._run('add', records)
+
+    def remove_records(self, records):
+        """Remove the given TXT records."""
+        self._run('remove', records)
+
+
+# #####################################################################################################
+# # Signing agent
+
+
+agent_key_prefix = "agent:"
+
+
+class SigningAgent(object):
+    """Signs JWS inputs with an account key on behalf of other processes.
+
+    The key file is only read when the agent is created; the key is kept in
+    memory afterwards, so it can be moved out of reach of other processes
+    once the agent runs. The JWK header and thumbprint are computed once.
+    Every signature is still created by running OpenSSL (twice for EC keys),
+    which reads the key from a pipe. Use ``serve()`` to make the agent
+    available to other processes over a Unix socket.
+    """
+
+    def __init__(self, account_key):
+        """Load the given account key."""
+        with open(account_key, "rb") as f:
+            self._key_data = f.read()
+        self.account_key_type, self.account_key, self.algorithm, self.header, self.thumbprint = parse_account_key(account_key)
+
+    def info(self):
+        """Return the public information on the account key as a dictionary."""
+        return {
+            'account_key_type': self.account_key_type,
+            'algorithm': 'rsa' if self.account_key_type == 'rsa' else self.algorithm.curve,
+            'header': self.header,
+            'thumbprint': self.thumbprint,
+        }
+
+    def sign(self, data):
+        """Sign the given JWS input (bytes). Returns the signature in JWS format."""
+        read_fd, write_fd = os.pipe()
+        try:
+            try:
+                key_data = self._key_data
+                while key_data:
+                    key_data = key_data[os.write(write_fd, key_data):]
+            finally:
+                os.close(write_fd)
+            return _sign_with_openssl(data, self.account_key_type, "/dev/fd/{0}".format(read_fd), self.algorithm, pass_fds=(read_fd, ))
+        finally:
+            os.close(read_fd)
+
+    def _handle(self, line):
+        try:
+            request = json.loads(line.decode('utf8'))
+            if request.get('op') == 'info':
+                response = self.info()
+            elif request.get('op') == 'sign':
+                response = {'signature': base64.b64encode(self.sign(base64.b64decode(request['data']))).decode('ascii')}
+            else:
+                response = {'error': "Unknown operation {0}".format(request.get('op'))}
+        except Exception as e:
+            response = {'error': str(e)}
+        return (json.dumps(response) + '\n').encode('utf8')
+
+    def serve(self, socket_path):
+        """Serve signing requests on the given Unix socket until interrupted.
+
+        The socket is only accessible by the current user.
+        """
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, b''):
+                    self.wfile.write(agent._handle(line))
+                    self.wfile.flush()
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.lexists(socket_path):
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise ValueError("{0} exists and is not a socket".format(socket_path))
+            try:
+                SigningAgentClient(socket_path).info()
+            except IOError:
+                os.remove(socket_path)
+            else:
+                raise ValueError("A signing agent is already listening on {0}".format(socket_path))
+        old_umask = os.umask(0o177)
+        try:
+            server = Server(socket_path, Handler)
+        finally:
+            os.umask(old_umask)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+
+
+class SigningAgentClient(object):
+    """Talks to a SigningAgent over its Unix socket."""
+
+    def __init__(self, socket_path):
+        """Create client for the agent listening on socket_path."""
+        self.socket_path = socket_path
+
+    def _call(self, request):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall((json.dumps(request) + '\n').encode('utf8'))
+            response = b''
+            while not response.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise IOError("Signing agent at {0} closed connection".format(self.socket_path))
+                response += chunk
+        finally:
+            sock.close()
+        response = json.loads(response.decode('utf8'))
+        if 'error' in response:
+            raise ValueError("Signing agent error: {0}".format(response['error']))
+        return response
+
+    def info(self):
+        """Return the public information on the agent's account key (see SigningAgent.info())."""
+        return self._call({'op': 'info'})
+
+    def sign(self, data):
+        """Sign the given JWS input (bytes) with the agent's account key."""
+        return base64.b64decode(self._call({'op': 'sign', 'data': base64.b64encode(data).decode('ascii')})['signature'])
+
+
 # #####################################################################################################
 # # Low level functions
 
@@ -168,16 +699,28 @@ def write_file(filename, content):
         f.write(content.encode('utf-8'))
 
 
+def write_file_atomic(filename, content):
+    """Write the contents (string) into the file, encoded with UTF-8, by atomically replacing the file."""
+    temp_filename = "{0}.{1}.{2}.tmp".format(filename, os.getpid(), threading.current_thread().ident)
+    try:
+        write_file(temp_filename, content)
+        os.rename(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
 def create_key(key_length=4096, algorithm="rsa"):
     """Create an RSA key with the given key length in bits."""
     algorithm = _get_algorithm(algorithm)
     return algorithm.create_key(key_length)
 
 
-def generate_csr(key_filename, config_filename, domains, must_staple=False):
+def generate_csr(key_filename, config_filename, domains, must_staple=False, key_data=None):
     """Given a private key and a list of domains, create a Certificate Signing Request (CSR).
 
     ``must_staple```: if set to ``True``, asks for a certificate with OCSP Must Staple enabled.
+    ``key_data``: if specified, the private key is taken from these bytes instead of key_filename.
     """
     # First generate config
     template = """HOME     = .
@@ -200,9 +743,10 @@ subjectAltName = {0}
         # instead.
     write_file(config_filename, template.format(','.join(['DNS:{0}'.format(domain) for domain in domains])))
     # Generate CSR
-    if key_filename == '/dev/stdin':
-        stdin = read_stdin()
-        return _run_openssl(['req', '-new', '-sha256', '-key', '/dev/stdin', '-subj', '/', '-config', config_filename], input=stdin).decode('utf-8')
+    if key_data is None and key_filename == '/dev/stdin':
+        key_data = read_stdin()
+    if key_data is not None:
+        return _run_openssl(['req', '-new', '-sha256', '-key', '/dev/stdin', '-subj', '/', '-config', config_filename], input=key_data).decode('utf-8')
     else:
         return _run_openssl(['req', '-new', '-sha256', '-key', key_filename, '-subj', '/', '-config', config_filename]).decode('utf-8')
 
@@ -217,7 +761,14 @@ def parse_account_key(account_key):
 
     Returns five variables (account_key_type, account_key, account_key_algorithm, header, thumbprint)
     needed for other low-level functions.
+
+    If account_key is of the form ``agent:/path/to/socket``, the public key
+    is retrieved from the signing agent listening on that socket, and all
+    requests will be signed by that agent.
     """
+    if account_key.startswith(agent_key_prefix):
+        info = SigningAgentClient(account_key[len(agent_key_prefix):]).info()
+        return info['account_key_type'], account_key, _get_algorithm(info['algorithm']), info['header'], info['thumbprint']
     sys.stderr.write("Parsing account key...")
     account_key_type = None
     with open(account_key, "r") as f:
@@ -283,6 +834,25 @@ def _lookup_directory(CA, *keys):
     return tuple([nonce] + urls)
 
 
+def _sign(data, account_key_type, account_key, account_key_algorithm):
+    """Helper function to create the JWS signature for the given data."""
+    if account_key.startswith(agent_key_prefix):
+        return SigningAgentClient(account_key[len(agent_key_prefix):]).sign(data)
+    return _sign_with_openssl(data, account_key_type, account_key, account_key_algorithm)
+
+
+def _sign_with_openssl(data, account_key_type, key_filename, account_key_algorithm, pass_fds=()):
+    """Helper function to create the JWS signature for the given data with the key in key_filename."""
+    out = _run_openssl(["dgst", "-{0}".format(account_key_algorithm.jws_hash), "-sign", key_filename], data, pass_fds=pass_fds)
+    if account_key_type == 'ec':
+        out = _run_openssl(["asn1parse", "-inform", "DER"], input=out).decode("utf8")
+        sig = re.findall(r"prim:\s+INTEGER\s+:([0-9A-F]{%s})\n" % (2 * account_key_algorithm.jws_hash_bytes), out)
+        if len(sig) != 2:
+            raise Exception("Failed to generate signature; cannot parse DER output:\n\n{0}".format(out))
+        out = binascii.unhexlify(sig[0]) + binascii.unhexlify(sig[1])
+    return out
+
+
 def _send_signed_request(payload, header, CA, account_key_type, account_key, account_key_algorithm, key=None, url=None):
     """Helper function make signed requests. Either ``key`` or ``url`` must be specified."""
     # Make sure we know the URL, and figure out nonce_url (and see if we get a nonce as well)
@@ -299,13 +869,7 @@ def _send_signed_request(payload, header, CA, account_key_type, account_key, acc
     protected = copy.deepcopy(header)
     protected.update({"nonce": nonce})
     protected64 = _b64(json.dumps(protected).encode('utf8'))
-    out = _run_openssl(["dgst", "-{0}".format(account_key_algorithm.jws_hash), "-sign", account_key], "{0}.{1}".format(protected64, payload64).encode('utf8'))
-    if account_key_type == 'ec':
-        out = _run_openssl(["asn1parse", "-inform", "DER"], input=out).decode("utf8")
-        sig = re.findall(r"prim:\s+INTEGER\s+:([0-9A-F]{%s})\n" % (2 * account_key_algorithm.jws_hash_bytes), out)
-        if len(sig) != 2:
-            raise Exception("Failed to generate signature; cannot parse DER output:\n\n{0}".format(out))
-        out = binascii.unhexlify(sig[0]) + binascii.unhexlify(sig[1])
+    out = _sign("{0}.{1}".format(protected64, payload64).encode('utf8'), account_key_type, account_key, account_key_algorithm)
     data = json.dumps({
         "header": header,
         "protected": protected64,
@@ -369,11 +933,13 @@ def register_account(header, CA, account_key_type, account_key, account_key_algo
         raise ValueError("Error registering: {0} {1}".format(code, result))
 
 
-def get_challenge(domain, header, CA, account_key_type, account_key, account_key_algorithm, thumbprint):
+def get_challenge(domain, header, CA, account_key_type, account_key, account_key_algorithm, thumbprint, challenge_type="http-01"):
     """Retrieve challenge for a domain.
 
     Returns the challenge object, the challenge token as well as the
-    content for the token file.
+    content for the token file (the key authorization).
+
+    ``challenge_type`` can be ``http-01`` (default) or ``dns-01``.
     """
     # get new challenge
     code, result = _send_signed_request({
@@ -384,7 +950,10 @@ def get_challenge(domain, header, CA, account_key_type, account_key, account_key
         raise ValueError("Error registering: {0} {1}".format(code, result))
 
     # make the challenge file
-    challenge = [c for c in json.loads(result.decode('utf8'))['challenges'] if c['type'] == "http-01"][0]
+    challenges = [c for c in json.loads(result.decode('utf8'))['challenges'] if c['type'] == challenge_type]
+    if not challenges:
+        raise ValueError("CA offers no {0} challenge for {1}".format(challenge_type, domain))
+    challenge = challenges[0]
     challenge['token'] = re.sub(r"[^A-Za-z0-9_\-]", "_", challenge['token'])
     keyauthorization = "{0}.{1}".format(challenge['token'], thumbprint)
     return challenge, challenge['token'], keyauthorization
@@ -395,6 +964,18 @@ def get_wellknown_url(domain, token):
     return "http://{0}/.well-known/acme-challenge/{1}".format(domain, token)
 
 
+def get_dns_record_name(domain):
+    """Return the name of the TXT record for a dns-01 challenge for the domain."""
+    if domain.startswith('*.'):
+        domain = domain[2:]
+    return "_acme-challenge.{0}".format(domain)
+
+
+def get_dns_record_value(keyauthorization):
+    """Return the content of the TXT record for a dns-01 challenge."""
+    return _b64(hashlib.sha256(keyauthorization.encode('utf8')).digest())
+
+
 def check_challenge(domain, token, keyauthorization):
     """Check whether the token is correctly placed on the server.
 
@@ -409,6 +990,27 @@ def check_challenge(domain, token, keyauthorization):
         return False
 
 
+def check_challenge_file(domain, token, keyauthorization, folder_for_domain):
+    """Check whether the token file is correctly placed on disk.
+
+    See documentation of write_challenges() for explanation of folder_for_domain.
+    Returns True in case it is, and False in case it is not.
+    """
+    try:
+        with open(_get_wellknown_path(domain, token, folder_for_domain), "rb") as f:
+            return f.read().decode('utf8').strip() == keyauthorization
+    except IOError:
+        return False
+
+
+def _get_backend(domain):
+    """Return the addresses the domain resolves to, or the domain itself if it cannot be resolved."""
+    try:
+        return tuple(sorted(set(info[4][0] for info in socket.getaddrinfo(domain, 80, 0, socket.SOCK_STREAM))))
+    except socket.error:
+        return domain
+
+
 def notify_challenge(domain, header, CA, account_key_type, account_key, account_key_algorithm, challenge, keyauthorization):
     """Notify the CA server that the token files are available on the webserver."""
     # notify challenge are met
@@ -491,9 +1093,11 @@ def deserialize_state(serialized_state):
     return result
 
 
-def get_challenges(account_key, csr, CA, email_address=None, telephone=None):
+def get_challenges(account_key, csr, CA, email_address=None, telephone=None, challenge_type="http-01"):
     """Set up the account and retrieve challenges from CA server.
 
+    ``challenge_type`` can be ``http-01`` (default) or ``dns-01``.
+
     Returns a state object.
     """
     account_key_type, account_key, account_key_algorithm, header, thumbprint = parse_account_key(account_key)
@@ -504,9 +1108,21 @@ def get_challenges(account_key, csr, CA, email_address=None, telephone=None):
     challenges = []
     # verify each domain
     for domain in domains:
-        challenge, token, keyauthorization = get_challenge(domain, header, CA, account_key_type, account_key, account_key_algorithm, thumbprint)
+        challenge, token, keyauthorization = get_challenge(domain, header, CA, account_key_type, account_key, account_key_algorithm, thumbprint, challenge_type=challenge_type)
         challenges.append({'domain': domain, 'challenge': challenge, 'token': token, 'keyauthorization': keyauthorization})
-    return {'account_key_type': account_key_type, 'account_key_algorithm': account_key_algorithm, 'account_key': account_key, 'header': header, 'thumbprint': thumbprint, 'CA': CA, 'challenges': challenges}
+    return {'account_key_type': account_key_type, 'account_key_algorithm': account_key_algorithm, 'account_key': account_key, 'header': header, 'thumbprint': thumbprint, 'CA': CA, 'challenge_type': challenge_type, 'challenges': challenges}
+
+
+def _group_challenges_by_folder(challenges, folder_for_domain):
+    """Resolve the folder for every challenge once, and group the challenges by folder."""
+    folders = {}
+    for challenge_entry in challenges:
+        if callable(folder_for_domain):
+            folder = folder_for_domain(challenge_entry['domain'])
+        else:
+            folder = folder_for_domain
+        folders.setdefault(folder, []).append(challenge_entry)
+    return sorted(folders.items())
 
 
 def write_challenges(state, folder_for_domain):
@@ -514,34 +1130,63 @@ def write_challenges(state, folder_for_domain):
 
     If the folder_for_domain parameter is a callable, it is expected to
     return a path when called with a single parameter, which will be the
-    domain name. Otherwise, it is assumed to be a string.
+    domain name (a WebrootMap can be used here). Otherwise, it is assumed
+    to be a string. The files are written folder by folder.
     """
-    challenges = state['challenges']
-    for challenge_entry in challenges:
-        domain = challenge_entry['domain']
-        token = challenge_entry['token']
-        keyauthorization = challenge_entry['keyauthorization']
-        wellknown_path = _get_wellknown_path(domain, token, folder_for_domain)
-        write_file(wellknown_path, keyauthorization)
+    for folder, challenges in _group_challenges_by_folder(state['challenges'], folder_for_domain):
+        if not os.path.isdir(folder):
+            raise ValueError("Folder '{0}' for challenge files does not exist".format(folder))
+        for challenge_entry in challenges:
+            write_file(os.path.join(folder, challenge_entry['token']), challenge_entry['keyauthorization'])
 
 
 def remove_challenges(state, folder_for_domain):
     """Remove the challenge files from disk.
 
     See documentation of write_challenges() for explanation
-    of folder_for_domain.
+    of folder_for_domain. Files which do not exist (for example
+    because write_challenges() failed) are skipped.
     """
-    challenges = state['challenges']
-    for challenge_entry in challenges:
-        domain = challenge_entry['domain']
-        token = challenge_entry['token']
-        wellknown_path = _get_wellknown_path(domain, token, folder_for_domain)
-        os.remove(wellknown_path)
+    for folder, challenges in _group_challenges_by_folder(state['challenges'], folder_for_domain):
+        for challenge_entry in challenges:
+            try:
+                os.remove(os.path.join(folder, challenge_entry['token']))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+def verify_challenges(state, folder_for_domain=None, per_backend=False):
+    """Verify that the challenge files are available.
 
+    By default, every challenge file is downloaded from the web server with HTTP.
 
-def verify_challenges(state):
-    """Verify that the challenge files are available on the web server with HTTP."""
+    If folder_for_domain is specified (see write_challenges()), the challenge
+    files are checked directly on disk instead, and no HTTP requests are made
+    unless per_backend is set to True.
+
+    If per_backend is set to True, the domains are grouped by the addresses
+    they resolve to, and only the first domain of every group is checked
+    with HTTP.
+    """
     challenges = state['challenges']
+    if folder_for_domain is not None:
+        for challenge_entry in challenges:
+            domain = challenge_entry['domain']
+            token = challenge_entry['token']
+            if not check_challenge_file(domain, token, challenge_entry['keyauthorization'], folder_for_domain):
+                raise ValueError("Couldn't find challenge file at {0}".format(_get_wellknown_path(domain, token, folder_for_domain)))
+        if not per_backend:
+            return
+    if per_backend:
+        backends = set()
+        representatives = []
+        for challenge_entry in challenges:
+            backend = _get_backend(challenge_entry['domain'])
+            if backend not in backends:
+                backends.add(backend)
+                representatives.append(challenge_entry)
+        challenges = representatives
     for challenge_entry in challenges:
         domain = challenge_entry['domain']
         token = challenge_entry['token']
@@ -550,6 +1195,50 @@ def verify_challenges(state):
             raise ValueError("Couldn't download challenge file at {0}".format(get_wellknown_url(domain, token)))
 
 
+def _get_dns_records(state):
+    """Return the list of ``(name, value)`` TXT records for the dns-01 challenges in the state."""
+    records = []
+    for challenge_entry in state['challenges']:
+        record = (get_dns_record_name(challenge_entry['domain']), get_dns_record_value(challenge_entry['keyauthorization']))
+        if record not in records:
+            records.append(record)
+    return records
+
+
+def write_dns_challenges(state, provider):
+    """Publish the TXT records for all dns-01 challenges with one call to the DNS provider."""
+    provider.add_records(_get_dns_records(state))
+
+
+def remove_dns_challenges(state, provider):
+    """Remove the TXT records for all dns-01 challenges with one call to the DNS provider."""
+    provider.remove_records(_get_dns_records(state))
+
+
+def wait_for_dns_challenges(state, nameservers, port=53, timeout=300, interval=5):
+    """Wait until the TXT records for all dns-01 challenges are visible on all given name servers.
+
+    All records are polled together, so there is only one propagation wait
+    for the whole order. Raises an exception if this takes longer than
+    ``timeout`` seconds.
+    """
+    pending = set((nameserver, name, value) for nameserver in nameservers for name, value in _get_dns_records(state))
+    deadline = time.time() + timeout
+    while True:
+        for nameserver, name, value in sorted(pending):
+            try:
+                if value in dns_query_txt(nameserver, name, port=port):
+                    pending.discard((nameserver, name, value))
+            except (IOError, ValueError):
+                pass
+        if not pending:
+            return
+        if time.time() >= deadline:
+            raise ValueError("TXT records not visible after {0} seconds: {1}".format(
+                timeout, ', '.join('{0} on {1}'.format(name, nameserver) for nameserver, name, value in sorted(pending))))
+        time.sleep(interval)
+
+
 def notify_challenges(state):
     """Notify the CA server that the challenges are ready."""
     challenges = state['challenges']
@@ -577,3 +1266,579 @@ def check_challenges(state, csr, inform=None):
         if callable(inform):
             inform(domain)
     return retrieve_certificate(csr, state['header'], state['CA'], state['account_key_type'], state['account_key'], state['account_key_algorithm'])
+
+
+_registrations = _SingleFlight()
+_authorizations = _SingleFlight()
+
+
+def authorize_domain(domain, header, CA, account_key_type, account_key, account_key_algorithm, thumbprint, folder_for_domain, verify=True, limit=None):
+    """Authorize the account for a domain with a http-01 challenge.
+
+    Retrieves the challenge, writes the challenge file (see write_challenges()
+    for folder_for_domain), verifies it with HTTP (if verify is True),
+    notifies the CA, waits for the validation and removes the file again.
+
+    Concurrent calls for the same CA, account and domain within this process
+    share one authorization: they wait for the running one and get its
+    outcome. If limit is specified, it must be a semaphore; it is held while
+    an authorization runs (but not while waiting for another caller's one).
+    Returns the validated challenge object.
+    """
+    def authorize():
+        if limit is not None:
+            with limit:
+                return run()
+        return run()
+
+    def run():
+        challenge, token, keyauthorization = get_challenge(domain, header, CA, account_key_type, account_key, account_key_algorithm, thumbprint)
+        wellknown_path = _get_wellknown_path(domain, token, folder_for_domain)
+        write_file(wellknown_path, keyauthorization)
+        try:
+            if verify and not check_challenge(domain, token, keyauthorization):
+                raise ValueError("Couldn't download challenge file at {0}".format(get_wellknown_url(domain, token)))
+            notify_challenge(domain, header, CA, account_key_type, account_key, account_key_algorithm, challenge, keyauthorization)
+            check_challenge_verified(domain, challenge, wait=True)
+        finally:
+            os.remove(wellknown_path)
+        return challenge
+
+    return _authorizations.do((CA, thumbprint, domain.lower()), authorize)
+
+
+def get_certificate(account_key, csr, CA, folder_for_domain, email_address=None, telephone=None, inform=None, verify=True, concurrency=8, limit=None):
+    """Set up the account, authorize all domains of the CSR and retrieve the certificate.
+
+    The domains are authorized with authorize_domain(), up to concurrency
+    at a time, so certificates retrieved concurrently in the same process
+    share the authorizations for common domains. limit is passed on to
+    authorize_domain(); if not specified, a semaphore allowing concurrency
+    authorizations is used. In case inform is specified, it is called with
+    the domain name as the only argument for every authorized domain.
+
+    Returns the certificate as a string.
+    """
+    if concurrency < 1:
+        raise ValueError("Concurrency must be at least 1!")
+    account_key_type, account_key, account_key_algorithm, header, thumbprint = parse_account_key(account_key)
+    domains = parse_csr(csr)
+    if limit is None:
+        limit = threading.BoundedSemaphore(concurrency)
+    _registrations.do((CA, thumbprint), lambda: register_account(header, CA, account_key_type, account_key, account_key_algorithm, email_address=email_address, telephone=telephone))
+
+    def authorize(domain):
+        authorize_domain(domain, header, CA, account_key_type, account_key, account_key_algorithm, thumbprint, folder_for_domain, verify=verify, limit=limit)
+        if callable(inform):
+            inform(domain)
+
+    results, errors = _run_parallel(authorize, domains, concurrency)
+    if errors:
+        raise ValueError("Authorization failed: {0}".format('; '.join('{0}: {1}'.format(domain, errors[domain]) for domain in sorted(errors))))
+    return retrieve_certificate(csr, header, CA, account_key_type, account_key, account_key_algorithm)
+
+
+def get_certificates(account_key, csrs, CA, folder_for_domain, email_address=None, telephone=None, inform=None, concurrency=8):
+    """Retrieve certificates for several CSRs concurrently with get_certificate().
+
+    At most concurrency certificates and concurrency authorizations are
+    processed at the same time. Authorizations for domains shared by CSRs
+    processed at the same time are coalesced. In case inform is specified,
+    it is called with the CSR and the domain name for every authorized domain.
+
+    Returns two dictionaries: one mapping CSRs to certificates, and one
+    mapping CSRs to errors for failed retrievals.
+    """
+    if concurrency < 1:
+        raise ValueError("Concurrency must be at least 1!")
+    limit = threading.BoundedSemaphore(concurrency)
+
+    def get(csr):
+        return get_certificate(account_key, csr, CA, folder_for_domain, email_address=email_address, telephone=telephone,
+                               inform=(lambda domain: inform(csr, domain)) if callable(inform) else None,
+                               concurrency=concurrency, limit=limit)
+
+    return _run_parallel(get, csrs, concurrency)
+
+
+# #####################################################################################################
+# # OCSP stapling
+
+
+default_ocsp_refresh_interval = 12 * 60 * 60
+
+
+def _parse_openssl_time(value):
+    """Convert a time as printed by OpenSSL (like ``Oct  5 12:00:00 2016 GMT``) to a timestamp."""
+    return calendar.timegm(time.strptime(value.strip(), "%b %d %H:%M:%S %Y %Z"))
+
+
+def get_ocsp_url(cert_filename):
+    """Return the OCSP responder URL of the given certificate."""
+    urls = _run_openssl(["x509", "-in", cert_filename, "-noout", "-ocsp_uri"]).decode('utf-8').split()
+    if not urls:
+        raise ValueError("Certificate '{0}' has no OCSP responder URL".format(cert_filename))
+    return urls[0]
+
+
+def is_ca_certificate(cert_filename):
+    """Check whether the (first) certificate in the given file is a CA certificate."""
+    out = _run_openssl(["x509", "-in", cert_filename, "-noout", "-text"]).decode('utf-8')
+    return re.search(r"X509v3 Basic Constraints:[^\n]*\n\s*CA:TRUE", out) is not None
+
+
+def get_ocsp_response_times(response_filename):
+    """Return the times (as timestamps) of the This Update and Next Update fields of a DER encoded OCSP response.
+
+    The second value is None if the response has no Next Update field.
+    """
+    out = _run_openssl(["ocsp", "-respin", response_filename, "-noverify", "-resp_text"]).decode('utf-8')
+    this_update = re.search(r"This Update: ([^\n]+)", out)
+    next_update = re.search(r"Next Update: ([^\n]+)", out)
+    if this_update is None:
+        raise ValueError("Cannot parse OCSP response '{0}'".format(response_filename))
+    return _parse_openssl_time(this_update.group(1)), _parse_openssl_time(next_update.group(1)) if next_update is not None else None
+
+
+def get_ocsp_refresh_time(response_filename):
+    """Return the time (as timestamp) when the given OCSP response should be refreshed.
+
+    This is half way between This Update and Next Update, so there is
+    enough time for retries before the response expires. Returns 0 if
+    the file does not exist or cannot be parsed.
+    """
+    try:
+        this_update, next_update = get_ocsp_response_times(response_filename)
+    except (IOError, ValueError):
+        return 0
+    if next_update is None:
+        return this_update + default_ocsp_refresh_interval
+    return this_update + (next_update - this_update) // 2
+
+
+def fetch_ocsp_response(cert_filename, issuer_filename, response_filename):
+    """Fetch the OCSP response for the certificate and store it (DER encoded) at response_filename.
+
+    The response is verified against the issuer certificate, and must
+    report the certificate as good. The file is replaced atomically.
+    Returns the time when the response should be refreshed.
+    """
+    temp_filename = "{0}.{1}.tmp".format(response_filename, os.getpid())
+    try:
+        out = _run_openssl(["ocsp", "-issuer", issuer_filename, "-cert", cert_filename, "-url", get_ocsp_url(cert_filename),
+                            "-VAfile", issuer_filename, "-no_nonce", "-respout", temp_filename]).decode('utf-8')
+        status = re.search(r": (good|revoked|unknown)\b", out)
+        if status is None or status.group(1) != 'good':
+            raise ValueError("OCSP status of '{0}' is {1}".format(cert_filename, status.group(1) if status is not None else 'unknown'))
+        os.rename(temp_filename, response_filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+    return get_ocsp_refresh_time(response_filename)
+
+
+def refresh_ocsp_responses(cert_filenames, issuer_filename, response_for_cert=None, concurrency=8, force=False, inform=None, cache=None):
+    """Fetch OCSP responses for all certificates whose stored response is missing or due for refresh.
+
+    If response_for_cert is a callable, it is called with the certificate
+    filename and must return the filename for the OCSP response. If it is a
+    string, the response is stored in that folder as ``<certificate>.ocsp``;
+    if it is None, it is stored next to the certificate.
+
+    Up to ``concurrency`` responses are fetched in parallel. If inform is
+    specified, it is called with the certificate filename for every fetched
+    response.
+
+    If cache is a dictionary, the refresh times of the stored responses are
+    kept in it together with the files' modification times, so that repeated
+    calls with the same cache only parse responses which have changed.
+
+    Returns two dictionaries: one mapping certificate filenames to the time
+    (as timestamp) when their response should be refreshed next, and one
+    mapping certificate filenames to errors for failed fetches.
+    """
+    def get_response_filename(cert_filename):
+        if callable(response_for_cert):
+            return response_for_cert(cert_filename)
+        return os.path.join(response_for_cert or os.path.dirname(cert_filename), os.path.basename(cert_filename) + '.ocsp')
+
+    def get_refresh_time(response_filename):
+        if cache is None:
+            return get_ocsp_refresh_time(response_filename)
+        try:
+            mtime = os.path.getmtime(response_filename)
+        except OSError:
+            return 0
+        cached = cache.get(response_filename)
+        if cached is None or cached[0] != mtime:
+            cached = cache[response_filename] = (mtime, get_ocsp_refresh_time(response_filename))
+        return cached[1]
+
+    refresh_times = {}
+    pending = []
+    now = time.time()
+    for cert_filename in cert_filenames:
+        refresh_time = 0 if force else get_refresh_time(get_response_filename(cert_filename))
+        if refresh_time > now:
+            refresh_times[cert_filename] = refresh_time
+        else:
+            pending.append(cert_filename)
+
+    def fetch(cert_filename):
+        response_filename = get_response_filename(cert_filename)
+        refresh_time = fetch_ocsp_response(cert_filename, issuer_filename, response_filename)
+        if cache is not None:
+            cache[response_filename] = (os.path.getmtime(response_filename), refresh_time)
+        if callable(inform):
+            inform(cert_filename)
+        return refresh_time
+
+    fetched, errors = _run_parallel(fetch, pending, concurrency)
+    refresh_times.update(fetched)
+    return refresh_times, errors
+
+
+# #####################################################################################################
+# # Webroot mapping
+
+
+class WebrootMap(object):
+    """Maps domains to webroots (folders for challenge files) with an index of reversed domain labels.
+
+    Supported patterns are exact domain names (``www.example.com``), all
+    subdomains of a domain (``*.example.com``), a domain together with all
+    its subdomains (``.example.com``), and ``*`` for all domains. Exact
+    patterns win; otherwise, the pattern for the longest domain wins, and
+    ``*.example.com`` wins over ``.example.com``. The first rule for a
+    pattern wins.
+
+    Instances can be used as folder_for_domain for write_challenges() and
+    related functions.
+    """
+
+    def __init__(self, rules=None):
+        """Create a map from a list of ``(pattern, webroot)`` tuples."""
+        # Every node is a list [children, exact, subdomains, suffix].
+        self._root = [{}, None, None, None]
+        for pattern, webroot in rules or []:
+            self.add(pattern, webroot)
+
+    def add(self, pattern, webroot):
+        """Add a rule to the map."""
+        name = pattern.lower().rstrip('.')
+        index = 1
+        if name == '*':
+            name, index = '', 2
+        elif name.startswith('*.'):
+            name, index = name[2:], 2
+        elif name.startswith('.'):
+            name, index = name[1:], 3
+        if '*' in name or not name and index != 2:
+            raise ValueError("Unsupported webroot map pattern '{0}'!".format(pattern))
+        node = self._root
+        for label in reversed(name.split('.')) if name else []:
+            node = node[0].setdefault(label, [{}, None, None, None])
+        if node[index] is None:
+            node[index] = webroot
+
+    def get(self, domain):
+        """Return the webroot for the given domain, or None if no rule matches."""
+        labels = domain.lower().rstrip('.').split('.')
+        node = self._root
+        result = node[2] or node[3]
+        for i, label in enumerate(reversed(labels)):
+            node = node[0].get(label)
+            if node is None:
+                return result
+            if i == len(labels) - 1:
+                return node[1] or node[3] or result
+            result = node[2] or node[3] or result
+        return result
+
+    def __call__(self, domain):
+        """Return the webroot for the given domain. Raises an exception if no rule matches."""
+        webroot = self.get(domain)
+        if webroot is None:
+            raise ValueError("No webroot known for domain '{0}'!".format(domain))
+        return webroot
+
+
+def read_webroot_map(filename):
+    """Read a file mapping domain patterns to webroots (see WebrootMap).
+
+    Every line must be of the form ``<pattern> <webroot>``; empty lines
+    and lines starting with ``#`` are ignored. Returns a WebrootMap.
+    """
+    result = WebrootMap()
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise ValueError("Invalid line in webroot map '{0}': {1}".format(filename, line))
+            result.add(parts[0], parts[1])
+    return result
+
+
+def _read_config_with_includes(filename, include_pattern, base_dir=None, visited=None):
+    """Read a web server configuration file, recursively inlining included files.
+
+    include_pattern must match a whole include directive, with the file
+    pattern in the group named ``pattern``; if a group named ``optional``
+    matches, no warning is shown when the file pattern matches no files.
+    Relative include patterns are resolved against base_dir (default: the
+    directory of filename). Every file is only included once.
+    """
+    base_dir = base_dir or os.path.dirname(os.path.abspath(filename))
+    visited = set() if visited is None else visited
+    visited.add(os.path.realpath(filename))
+    with open(filename, "r") as f:
+        content = f.read()
+
+    def include(m):
+        pattern = m.group('pattern').strip('"\'')
+        filenames = sorted(glob.glob(os.path.join(base_dir, pattern)))
+        if not filenames and not m.groupdict().get('optional'):
+            sys.stderr.write("Warning: include '{0}' in '{1}' matches no files.\n".format(pattern, filename))
+        contents = []
+        for included in filenames:
+            if os.path.realpath(included) in visited:
+                sys.stderr.write("Warning: '{0}' is included more than once; ignoring.\n".format(included))
+                continue
+            contents.append(_read_config_with_includes(included, include_pattern, base_dir, visited))
+        return '\n'.join(contents)
+
+    return re.sub(include_pattern, include, content)
+
+
+def _get_wellknown_folder(root):
+    return os.path.join(root, '.well-known', 'acme-challenge')
+
+
+_SERVER_NAME_PATTERN = re.compile(r"^(\*\.|\.)?[A-Za-z0-9][A-Za-z0-9_-]*(\.[A-Za-z0-9_-]+)*$")
+
+
+def read_nginx_webroots(filename):
+    """Extract ``(pattern, webroot)`` rules from the server blocks of an nginx configuration.
+
+    The webroot is taken from a ``/.well-known/acme-challenge/`` location
+    (``alias`` or ``root``) if present, and otherwise from the server's
+    ``root``. Regular expression server names are ignored.
+    """
+    content = _read_config_with_includes(filename, r"(?m)^\s*include\s+(?P<pattern>[^;]+);")
+    content = re.sub(r"(?m)#.*$", "", content)
+    rules = []
+    for m in re.finditer(r"\bserver\s*\{", content):
+        depth, start, position = 1, m.end(), m.end()
+        while depth > 0 and position < len(content):
+            depth += {'{': 1, '}': -1}.get(content[position], 0)
+            position += 1
+        block = content[start:position - 1]
+        top_level, previous = block, None
+        while top_level != previous:
+            top_level, previous = re.sub(r"\{[^{}]*\}", "", top_level), top_level
+        webroot = None
+        location = re.search(r"location\s+(?:\^~\s+|=\s+)?/\.well-known/acme-challenge/?\s*\{([^}]*)\}", block)
+        if location is not None:
+            alias = re.search(r"\balias\s+([^;]+);", location.group(1))
+            root = re.search(r"\broot\s+([^;]+);", location.group(1))
+            if alias is not None:
+                webroot = alias.group(1).strip('"\'')
+            elif root is not None:
+                webroot = _get_wellknown_folder(root.group(1).strip('"\''))
+        if webroot is None:
+            root = re.search(r"\broot\s+([^;]+);", top_level)
+            if root is None:
+                continue
+            webroot = _get_wellknown_folder(root.group(1).strip('"\''))
+        if '$' in webroot:
+            continue
+        for server_names in re.findall(r"\bserver_name\s+([^;]+);", top_level):
+            rules.extend((name, webroot) for name in server_names.split() if _SERVER_NAME_PATTERN.match(name))
+    return rules
+
+
+def read_apache_webroots(filename, server_root=None):
+    """Extract ``(pattern, webroot)`` rules from the virtual hosts of an Apache configuration.
+
+    The webroot is taken from an ``Alias`` for ``/.well-known/acme-challenge/``
+    if present, and otherwise from the ``DocumentRoot``. Relative includes
+    are resolved against server_root, which defaults to the ``ServerRoot``
+    directive of the configuration file (or its directory if there is none).
+    """
+    if server_root is None:
+        with open(filename, "r") as f:
+            m = re.search(r"(?im)^\s*ServerRoot\s+\"?([^\"\n]+?)\"?\s*$", f.read())
+        if m is not None:
+            server_root = m.group(1)
+    content = _read_config_with_includes(filename, r"(?im)^\s*Include(?P<optional>Optional)?\s+(?P<pattern>\S+)\s*$", base_dir=server_root)
+    rules = []
+    for block in re.findall(r"(?is)<VirtualHost[^>]*>(.*?)</VirtualHost>", content):
+        alias = re.search(r"(?im)^\s*Alias\s+\"?/\.well-known/acme-challenge/?\"?\s+\"?([^\"\n]+?)\"?\s*$", block)
+        root = re.search(r"(?im)^\s*DocumentRoot\s+\"?([^\"\n]+?)\"?\s*$", block)
+        if alias is not None:
+            webroot = alias.group(1)
+        elif root is not None:
+            webroot = _get_wellknown_folder(root.group(1))
+        else:
+            continue
+        for names in re.findall(r"(?im)^\s*Server(?:Name|Alias)\s+([^\n]+)$", block):
+            names = [name.split(':')[0] for name in names.split()]
+            rules.extend((name, webroot) for name in names if _SERVER_NAME_PATTERN.match(name))
+    return rules
+
+
+# #####################################################################################################
+# # Certificate planning
+
+
+_SECOND_LEVEL_LABELS = set(['ac', 'co', 'com', 'edu', 'gov', 'net', 'org'])
+
+
+def get_registered_domain(domain):
+    """Approximate the registered domain of the given domain name.
+
+    This does not use the Public Suffix List; it takes the last two labels,
+    or the last three for names like ``example.co.uk``.
+    """
+    labels = domain.lower().rstrip('.').split('.')
+    if labels[0] == '*':
+        labels = labels[1:]
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in _SECOND_LEVEL_LABELS:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def read_domain_list(filename):
+    """Read a list of domains from a file (one or more per line, separated by whitespace or commas).
+
+    Lines starting with ``#`` are ignored.
+    """
+    domains = []
+    with open(filename, "r") as f:
+        for line in f:
+            if not line.strip().startswith('#'):
+                domains.extend(domain for domain in re.split(r"[\s,]+", line) if domain)
+    return domains
+
+
+def _pack_domains(domains, max_sans, group_for_domain):
+    """Distribute domains over certificates with first-fit decreasing bin packing.
+
+    Domains of the same group are kept together, except when the group
+    is larger than max_sans.
+    """
+    groups = {}
+    for domain in sorted(domains):
+        groups.setdefault(group_for_domain(domain) if group_for_domain is not None else domain, []).append(domain)
+    units = []
+    for group in groups.values():
+        units.extend(group[i:i + max_sans] for i in range(0, len(group), max_sans))
+    certificates = []
+    for unit in sorted(units, key=lambda unit: (-len(unit), unit)):
+        for certificate in certificates:
+            if len(certificate) + len(unit) <= max_sans:
+                certificate.extend(unit)
+                break
+        else:
+            certificates.append(list(unit))
+    return [sorted(certificate) for certificate in certificates]
+
+
+def plan_certificates(domains, max_sans=100, group_for_domain=None, existing_csrs=None):
+    """Distribute the given domains over few certificates (orders).
+
+    Every certificate gets at most ``max_sans`` domains. The domains are
+    distributed with the first-fit decreasing heuristic, which is fast but
+    not guaranteed to find the smallest possible number of certificates. If ``group_for_domain``
+    is specified, it is called with a domain name and must return a group key
+    (for example ``get_registered_domain``); domains of one group are put into
+    the same certificate unless the group is too large.
+
+    ``existing_csrs`` is a list of CSR filenames. A CSR is reused if all its
+    domains are requested and not covered yet, it does not exceed ``max_sans``,
+    and reusing it does not increase the number of certificates.
+
+    Returns a list of dictionaries with keys ``domains`` (sorted list) and
+    ``csr`` (filename of the reused CSR, or ``None`` for a new one).
+    """
+    if max_sans < 1:
+        raise ValueError("The maximal number of domains per certificate must be at least 1!")
+    remaining = set(domain.lower() for domain in domains)
+    jobs = []
+    candidates = [(parse_csr(csr), csr) for csr in existing_csrs or []]
+    for csr_domains, csr in sorted(candidates, key=lambda candidate: (-len(candidate[0]), candidate[1])):
+        csr_domains = set(domain.lower() for domain in csr_domains)
+        if not csr_domains or len(csr_domains) > max_sans or not csr_domains.issubset(remaining):
+            continue
+        if len(_pack_domains(remaining - csr_domains, max_sans, group_for_domain)) + 1 <= len(_pack_domains(remaining, max_sans, group_for_domain)):
+            jobs.append({'domains': sorted(csr_domains), 'csr': csr})
+            remaining -= csr_domains
+    for certificate in _pack_domains(remaining, max_sans, group_for_domain):
+        jobs.append({'domains': certificate, 'csr': None})
+    return jobs
+
+
+# #####################################################################################################
+# # Key and CSR store
+
+
+def ensure_key(key_filename, max_age=None, key_length=4096, algorithm="rsa"):
+    """Create a private key if the file does not exist, or if it is older than max_age seconds.
+
+    The key file is replaced atomically. Returns True if a new key was created.
+    """
+    if os.path.exists(key_filename) and (max_age is None or time.time() - os.path.getmtime(key_filename) < max_age):
+        return False
+    write_file_atomic(key_filename, create_key(key_length=key_length, algorithm=algorithm))
+    return True
+
+
+def get_csr_store_key(key_filename, domains, must_staple=False):
+    """Return the identifier of a CSR in the CSR store.
+
+    It is derived from the SHA-256 hash of the key file's content, the set of
+    domains (case-insensitive) and the must_staple flag.
+    """
+    with open(key_filename, "rb") as f:
+        return _get_csr_store_key(f.read(), domains, must_staple=must_staple)
+
+
+def _get_csr_store_key(key_data, domains, must_staple=False):
+    key_fingerprint = hashlib.sha256(key_data.strip()).hexdigest()
+    data = json.dumps([key_fingerprint, sorted(set(domain.lower() for domain in domains)), bool(must_staple)])
+    return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+
+def get_stored_csr(store_dir, key_filename, domains, must_staple=False):
+    """Return the CSR for the key and domains from the CSR store.
+
+    If the store does not have such a CSR yet, it is created with
+    generate_csr() and written atomically into the store. Returns the CSR
+    and whether it was created. The key file is only read once, so the CSR
+    always belongs to the key it is stored for, even if the key is replaced
+    at the same time.
+    """
+    with open(key_filename, "rb") as f:
+        key_data = f.read()
+    store_key = _get_csr_store_key(key_data, domains, must_staple=must_staple)
+    folder = os.path.join(store_dir, store_key[:2])
+    csr_filename = os.path.join(folder, store_key + '.csr')
+    if os.path.exists(csr_filename):
+        with open(csr_filename, "r") as f:
+            return f.read(), False
+    try:
+        os.makedirs(folder)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    config_filename = "{0}.{1}.{2}.cnf".format(csr_filename[:-4], os.getpid(), threading.current_thread().ident)
+    try:
+        csr = generate_csr(key_filename, config_filename, sorted(set(domain.lower() for domain in domains)), must_staple=must_staple, key_data=key_data)
+    finally:
+        if os.path.exists(config_filename):
+            os.remove(config_filename)
+    write_file_atomic(csr_filename, csr)
+    return csr, True
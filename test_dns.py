@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Checks the DNS support of acme_lib against a local stand-in DNS server.
+
+Run with ``python test_dns.py``. The stand-in server only uses the standard
+library; it parses the messages independently of acme_lib, accepts RFC 2136
+updates of TXT records (checking their TSIG signature), and answers TXT and
+NS queries over UDP and TCP.
+"""
+
+import base64
+import hashlib
+import hmac
+import socket
+import struct
+import threading
+import unittest
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+import acme_lib
+
+
+ZONE = 'example.com'
+TSIG_KEY = ('update-key', 'hmac-sha256', base64.b64encode(b'0123456789abcdef0123456789abcdef').decode('ascii'))
+
+
+def _read_name(data, offset):
+    """Decode the (uncompressed) name at offset. Returns the name and the offset after it."""
+    labels = []
+    while True:
+        length = struct.unpack_from('!B', data, offset)[0]
+        offset += 1
+        if length == 0:
+            return '.'.join(labels), offset
+        labels.append(data[offset:offset + length].decode('ascii'))
+        offset += length
+
+
+def _read_rr(data, offset):
+    """Decode the resource record at offset. Returns the record and the offset after it."""
+    start = offset
+    name, offset = _read_name(data, offset)
+    rrtype, rrclass, ttl, rdlength = struct.unpack_from('!HHIH', data, offset)
+    offset += 10
+    return (start, name, rrtype, rrclass, ttl, data[offset:offset + rdlength]), offset + rdlength
+
+
+def _encode_name(name):
+    return b''.join(struct.pack('!B', len(label)) + label.encode('ascii') for label in name.split('.')) + b'\x00'
+
+
+class StandInDNSServer(object):
+    """Authoritative stand-in server for ZONE which can be updated with RFC 2136."""
+
+    def __init__(self, nameservers=('ns1', 'ns2'), truncate_udp=False):
+        self.records = {}
+        self.nameservers = nameservers
+        self.truncate_udp = truncate_udp
+        self.updates = 0
+        self.tcp_queries = 0
+        stand_in = self
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                sock.sendto(stand_in.handle(data, udp=True), self.client_address)
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data = b''
+                while len(data) < 2 or len(data) < 2 + struct.unpack_from('!H', data, 0)[0]:
+                    chunk = self.request.recv(65535)
+                    if not chunk:
+                        return
+                    data += chunk
+                stand_in.tcp_queries += 1
+                response = stand_in.handle(data[2:], udp=False)
+                self.request.sendall(struct.pack('!H', len(response)) + response)
+
+        self.udp = socketserver.UDPServer(('127.0.0.1', 0), UDPHandler)
+        self.port = self.udp.server_address[1]
+        self.tcp = socketserver.TCPServer(('127.0.0.1', self.port), TCPHandler)
+        for server in (self.udp, self.tcp):
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        for server in (self.udp, self.tcp):
+            server.shutdown()
+            server.server_close()
+
+    def _response(self, request, question_end, rcode, answers=b'', ancount=0, truncated=False):
+        message_id, flags = struct.unpack_from('!HH', request, 0)
+        flags = 0x8400 | (flags & 0x7900) | (0x0200 if truncated else 0) | rcode
+        qdcount = struct.unpack_from('!H', request, 4)[0]
+        return struct.pack('!HHHHHH', message_id, flags, qdcount, ancount, 0, 0) + request[12:question_end] + answers
+
+    def _check_tsig(self, data, tsig_rr):
+        start, key_name, rrtype, rrclass, ttl, rdata = tsig_rr
+        algorithm, offset = _read_name(rdata, 0)
+        time_signed = rdata[offset:offset + 8]
+        mac_size = struct.unpack_from('!H', rdata, offset + 8)[0]
+        mac = rdata[offset + 10:offset + 10 + mac_size]
+        original_id = struct.unpack_from('!H', rdata, offset + 10 + mac_size)[0]
+        unsigned = struct.pack('!H', original_id) + data[2:10] + struct.pack('!H', struct.unpack_from('!H', data, 10)[0] - 1) + data[12:start]
+        variables = _encode_name(key_name.lower()) + struct.pack('!HI', 255, 0) + _encode_name(algorithm) + time_signed + struct.pack('!HH', 0, 0)
+        expected = hmac.new(base64.b64decode(TSIG_KEY[2]), unsigned + variables, hashlib.sha256).digest()
+        return key_name == TSIG_KEY[0] and algorithm == 'hmac-sha256' and hmac.compare_digest(mac, expected)
+
+    def handle(self, data, udp):
+        flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHHH', data, 2)
+        name, offset = _read_name(data, 12)
+        rrtype = struct.unpack_from('!H', data, offset)[0]
+        question_end = offset + 4
+        if (flags >> 11) & 0xF == 5:
+            records = []
+            offset = question_end
+            for i in range(ancount + nscount + arcount):
+                rr, offset = _read_rr(data, offset)
+                records.append(rr)
+            if not records or records[-1][2] != 250 or not self._check_tsig(data, records[-1]):
+                return self._response(data, question_end, 9)
+            if name != ZONE or rrtype != 6:
+                return self._response(data, question_end, 10)
+            for start, rr_name, rr_type, rr_class, ttl, rdata in records[ancount:ancount + nscount]:
+                values = self.records.setdefault(rr_name.lower(), [])
+                value = rdata[1:].decode('ascii')
+                if rr_class == 1 and value not in values:
+                    values.append(value)
+                elif rr_class == 254 and value in values:
+                    values.remove(value)
+            self.updates += 1
+            return self._response(data, question_end, 0)
+        if udp and self.truncate_udp:
+            return self._response(data, question_end, 0, truncated=True)
+        if rrtype == 2 and name.lower() == ZONE:
+            # Compress the NS names by pointing to the question name at offset 12
+            answers = [struct.pack('!B', len(ns)) + ns.encode('ascii') + b'\xc0\x0c' for ns in self.nameservers]
+        elif rrtype == 16 and self.records.get(name.lower()):
+            answers = [struct.pack('!B', len(value)) + value.encode('ascii') for value in self.records[name.lower()]]
+        else:
+            return self._response(data, question_end, 0 if name.lower().endswith(ZONE) else 3)
+        encoded = b''.join(b'\xc0\x0c' + struct.pack('!HHIH', rrtype, 1, 60, len(rdata)) + rdata for rdata in answers)
+        return self._response(data, question_end, 0, encoded, len(answers))
+
+
+class DNSTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInDNSServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_update_and_query_txt(self):
+        name = '_acme-challenge.www.example.com'
+        acme_lib.dns_update('127.0.0.1', ZONE, add=[(name, 'first'), (name, 'second')], port=self.server.port, tsig_key=TSIG_KEY)
+        self.assertEqual(acme_lib.dns_query_txt('127.0.0.1', name, port=self.server.port), ['first', 'second'])
+        acme_lib.dns_update('127.0.0.1', ZONE, delete=[(name, 'first')], port=self.server.port, tsig_key=TSIG_KEY)
+        self.assertEqual(acme_lib.dns_query_txt('127.0.0.1', name, port=self.server.port), ['second'])
+        self.assertEqual(acme_lib.dns_query_txt('127.0.0.1', 'other.example.com', port=self.server.port), [])
+        self.assertEqual(acme_lib.dns_query_txt('127.0.0.1', 'example.org', port=self.server.port), [])
+
+    def test_update_with_wrong_tsig_key(self):
+        wrong_key = (TSIG_KEY[0], TSIG_KEY[1], base64.b64encode(b'wrong').decode('ascii'))
+        with self.assertRaises(ValueError) as context:
+            acme_lib.dns_update('127.0.0.1', ZONE, add=[('_acme-challenge.example.com', 'x')], port=self.server.port, tsig_key=wrong_key)
+        self.assertIn('NOTAUTH', str(context.exception))
+        self.assertEqual(self.server.updates, 0)
+
+    def test_query_ns(self):
+        self.assertEqual(acme_lib.dns_query_ns('127.0.0.1', ZONE, port=self.server.port), ['ns1.example.com', 'ns2.example.com'])
+
+    def test_tcp_fallback(self):
+        name = '_acme-challenge.example.com'
+        records = [(name, 'value-{0}-{1}'.format(i, 'x' * 40)) for i in range(12)]
+        acme_lib.dns_update('127.0.0.1', ZONE, add=records, port=self.server.port, tsig_key=TSIG_KEY)
+        self.assertEqual(self.server.tcp_queries, 1)
+        self.server.truncate_udp = True
+        self.assertEqual(acme_lib.dns_query_txt('127.0.0.1', name, port=self.server.port), [value for name, value in records])
+        self.assertEqual(self.server.tcp_queries, 2)
+
+    def test_provider_and_propagation(self):
+        provider = acme_lib.RFC2136DNSProvider('127.0.0.1', ZONE, port=self.server.port, tsig_key=TSIG_KEY)
+        state = {'challenges': [
+            {'domain': 'example.com', 'keyauthorization': 'token1.thumbprint'},
+            {'domain': '*.example.com', 'keyauthorization': 'token2.thumbprint'},
+            {'domain': 'www.example.com', 'keyauthorization': 'token3.thumbprint'},
+        ]}
+        acme_lib.write_dns_challenges(state, provider)
+        self.assertEqual(self.server.updates, 1)
+        acme_lib.wait_for_dns_challenges(state, ['127.0.0.1'], port=self.server.port, timeout=0)
+        self.assertEqual(len(self.server.records['_acme-challenge.example.com']), 2)
+        acme_lib.remove_dns_challenges(state, provider)
+        self.assertEqual(self.server.updates, 2)
+        with self.assertRaises(ValueError):
+            acme_lib.wait_for_dns_challenges(state, ['127.0.0.1'], port=self.server.port, timeout=0)
+
+
+if __name__ == '__main__':
+    unittest.main()